@@ -4,8 +4,18 @@ from __future__ import print_function
 import sip
 sip.setapi('QString', 1)
 
+import os
 import sys
 import copy
+import pickle
+import hashlib
+import mmap
+import re
+
+try:
+	from collections.abc import Mapping
+except ImportError: # Python 2
+	from collections import Mapping
 
 import configobj
 import validate
@@ -13,6 +23,8 @@ import validate
 from PyQt4 import QtGui
 from PyQt4 import QtCore
 
+__version__ = '0.1'
+
 class Option(object):
 	"""Description and value of an option"""
 	def __init__(self, name, section, type, args, kwargs, default, comment, widget_maker, check):
@@ -30,14 +42,20 @@ class Option(object):
 		"""Get current value of the option"""
 		return self.section[self.name]
 
-	def set(self, value):
-		"""Get current value of the option"""
+	def convert(self, value):
+		"""Check value against the spec and return it converted to the proper type. Raises an exception if value is invalid"""
 		# Workaround for problem in validate with lists from string
+		if isinstance(value, (list, tuple)):
+			value = ', '.join([str(x) for x in value])
 		value = str(value) # Start with a normal string
 		if self.type.endswith('list'):
 			value = [x.strip() for x in value.split(',')]
+		return self.check(value, *self.args, **self.kwargs)
+
+	def set(self, value):
+		"""Get current value of the option"""
 		try:
-			self.section[self.name] = self.check(value, *self.args, **self.kwargs)
+			self.section[self.name] = self.convert(value)
 		except:
 			pass
 
@@ -61,20 +79,40 @@ class ConfigPage(QtGui.QWidget):
 	"""Container for widgets describing options in a section"""
 	def __init__(self, section, item, parent=None):
 		QtGui.QWidget.__init__(self, parent)
-		layout = QtGui.QFormLayout(self)
+		self.setLayout(QtGui.QFormLayout())
 
 		for option in [section[x] for x in section.scalars]:
-			valueWidget = option.widget()
-			valueWidget.optionChanged.connect(self.optionChanged.emit) 
-			option_title = option.name.replace('_',' ')
-			option_title = option_title[0].upper() + option_title[1:]
-			layout.addRow(option_title, valueWidget)
+			self.addOption(option)
 
 		self.item = item # Store SectionBrowser item corresponding to this page
 		self.conf = section # Store configuration section corresponding to this page
 
 	optionChanged = QtCore.pyqtSignal(Option) # Chain signal upwards
 
+	def addOption(self, option, row=-1):
+		"""Create widget for option and add it to the page at row (last if negative)"""
+		valueWidget = option.widget()
+		option.editor = valueWidget # Allow refreshing the widget after programmatic changes
+		valueWidget.optionChanged.connect(self.optionChanged.emit)
+		option_title = option.name.replace('_',' ')
+		option_title = option_title[0].upper() + option_title[1:]
+		self.layout().insertRow(row, option_title, valueWidget)
+
+	def removeOption(self, option):
+		"""Remove the widget of option from the page and return the row it was on"""
+		layout = self.layout()
+		row, role = layout.getWidgetPosition(option.editor)
+		label = layout.labelForField(option.editor)
+		for widget in [label, option.editor]:
+			layout.removeWidget(widget)
+			widget.hide()
+			widget.deleteLater()
+		return row
+
+	def replaceOption(self, old, new):
+		"""Replace the widget of option old with one for option new"""
+		self.addOption(new, self.removeOption(old))
+
 	def restoreDefault(self):
 		"""Restore default value to all widgets on the page"""
 		for widget in [self.layout().itemAt(i) for i in range(self.layout().count())]:
@@ -182,12 +220,20 @@ class SectionBrowser(QtGui.QWidget):
 			self.addSection(combined)
 			self.sectionAdded.emit(combined)
 
+	def removePages(self, section):
+		"""Remove treeview items and pages of section and its subsections without touching the configuration"""
+		for subsection in [section[x] for x in section.sections]:
+			self.removePages(subsection)
+		item = section.tree_item
+		item.parent().removeChild(item)
+		self.pageRemoved.emit(self.page_lookup.pop(id(item)))
+
 	def removeSection(self, item):
 		"""Delete configuration section corresponding to item"""
 		item.parent().removeChild(item)
 		page = self.page_lookup[id(item)]
-		self.sectionRemoved.emit(page.conf)
 		del page.conf.conf.parent[str(item.text(0))]
+		self.sectionRemoved.emit(page.conf) # After deleting, so listeners see the configuration without it
 		self.pageRemoved.emit(page)
 		del self.page_lookup[id(item)]
 
@@ -254,11 +300,8 @@ class MyWidget(QtGui.QWidget):
 
 	def validate(self, value):
 		"""Check if the entered value is valid accoring to the spec"""
-		value = str(value) # Start with a normal string
-		if self.option.type.endswith('list'):
-			value = [x.strip() for x in value.split(',')]
 		try:
-			self.option.check(value, *self.option.args, **self.option.kwargs)
+			self.option.convert(value)
 		except Exception as e:
 			self.isValidIcon.setToolTip(str(e))
 			self.isValidIcon.show()
@@ -304,6 +347,15 @@ class MyWidget(QtGui.QWidget):
 		if self.option.isDefault():
 			self.setIsDefault()
 
+	def refresh(self):
+		"""Update widget after the option was changed from outside the widget"""
+		self.onlywidget = True
+		self.updateDisplay()
+		self.onlywidget = False
+		if not self.option.isDefault():
+			self.unsetIsDefault()
+		self.isValidIcon.hide()
+
 	optionChanged = QtCore.pyqtSignal(Option)
 
 	def setValue(self, value):
@@ -398,6 +450,59 @@ class MyComboBox(MyWidget):
 		if self.option.get() != None:
 			self.main_widget.setCurrentIndex(self.main_widget.findText(self.option.get()))
 
+class ChoiceModel(QtGui.QStringListModel):
+	"""List model of the choices of an option, with a hashed lookup of the row of a value"""
+	def __init__(self, options, parent=None):
+		QtGui.QStringListModel.__init__(self, [str(x) for x in options], parent)
+		self.rows = {}
+		for row, value in enumerate(options):
+			self.rows.setdefault(str(value), row) # Like findText, use the first of duplicate choices
+
+	def row(self, value):
+		"""Get the row of value, or -1 if it is not one of the choices"""
+		return self.rows.get(str(value), -1)
+
+choice_models = {} # Mapping from choices to the ChoiceModel shared by all options with those choices
+def choice_model(options):
+	"""Get the shared ChoiceModel for options"""
+	key = tuple(options)
+	if key not in choice_models:
+		choice_models[key] = ChoiceModel(options)
+	return choice_models[key]
+
+class MyChoicePicker(MyWidget):
+	"""Widget representing a multiple-choice option with many choices, with type-ahead completion"""
+	def __init__(self, option, options=[], parent=None):
+		MyWidget.__init__(self, option, parent)
+		main_widget = QtGui.QComboBox(self)
+		self.model = choice_model(options)
+		main_widget.setModel(self.model)
+		main_widget.setEditable(True)
+		main_widget.setInsertPolicy(QtGui.QComboBox.NoInsert)
+
+		completer = QtGui.QCompleter(self.model, main_widget)
+		completer.setCaseSensitivity(QtCore.Qt.CaseInsensitive)
+		completer.setCompletionMode(QtGui.QCompleter.PopupCompletion)
+		main_widget.setCompleter(completer)
+
+		self.init(option, main_widget, 'currentIndexChanged(QString)')
+		main_widget.lineEdit().textEdited.connect(self.validate) # Warn about text which is not one of the choices
+
+		# Qt4 only changes the current index when Enter is pressed, so also select on completion and focus loss
+		completer.activated['QString'].connect(self.selectText)
+		main_widget.lineEdit().editingFinished.connect(lambda: self.selectText(main_widget.lineEdit().text()))
+
+	def selectText(self, text):
+		"""Make the choice matching text current, which saves it through currentIndexChanged"""
+		row = self.model.row(text)
+		if row != -1 and row != self.main_widget.currentIndex():
+			self.main_widget.setCurrentIndex(row)
+
+	def updateDisplay(self):
+		MyWidget.updateDisplay(self)
+		if self.option.get() != None:
+			self.main_widget.setCurrentIndex(self.model.row(self.option.get()))
+
 class SliderWithLineEdit(QtGui.QWidget):
 	"""Slider which displays its current value in a box next to it"""
 	def __init__(self, type, min, max, parent = None):
@@ -542,9 +647,14 @@ def create_widget_boolean(option):
 	widget = MyCheckBox(option)
 	return widget
 
+LARGE_CHOICES = 100 # Number of choices above which option options get a MyChoicePicker
+
 def create_widget_option(option, *options):
 	"""Create widget for option option"""
-	widget = MyComboBox(option, options)
+	if len(options) > LARGE_CHOICES:
+		widget = MyChoicePicker(option, options)
+	else:
+		widget = MyComboBox(option, options)
 	return widget
 
 def create_widget_list(option, min=None, max=None):
@@ -593,6 +703,7 @@ class ConfigWindow(QtGui.QMainWindow):
 			self.original_conf = conf
 
 		self.conf = conf
+		self.snapshot = freeze_section(self.original_conf, None, set(), 0) # Latest published ConfigSnapshot
 
 		self.setWindowTitle(title)
 		options = merge_spec(conf, spec, self.type_mapping)
@@ -606,12 +717,16 @@ class ConfigWindow(QtGui.QMainWindow):
 		self.splitter = splitter
 
 		browser = SectionBrowser(conf, self.validator)
+		browser.type_mapping = self.type_mapping
+		self.browser = browser
 		browser.currentItemChanged.connect(self.changePage)
 		browser.pageAdded.connect(self.addPage)
 		browser.pageRemoved.connect(self.removePage)
 
 		if when_apply == ConfigWindow.APPLY_IMMEDIATELY: 
+			browser.sectionAdded.connect(lambda section: self.publishSnapshot([section_path(section)]))
 			browser.sectionAdded.connect(self.sectionAdded.emit)
+			browser.sectionRemoved.connect(lambda section: self.publishSnapshot([section_path(section)[:-1]]))
 			browser.sectionRemoved.connect(self.sectionRemoved.emit)
 
 		if spec.sections != []: # Sections are possible
@@ -651,11 +766,18 @@ class ConfigWindow(QtGui.QMainWindow):
 		self.stacked = stacked
 
 		self.pages = {}
+		self.index = {} # Mapping from option path to Option, kept up to date by addPage and removePage
 		pages = browser.addSection(options)
 
+		self.subscriptions = PathTrie() # Handlers subscribed to changes below a path
+		self.optionChanged.connect(lambda option: self.notifySubscribers('optionChanged', section_path(option.section) + [option.name], option))
+		self.sectionAdded.connect(lambda section: self.notifySubscribers('sectionAdded', section_path(section), section))
+		self.sectionRemoved.connect(lambda section: self.notifySubscribers('sectionRemoved', section_path(section), section))
+
 	optionChanged = QtCore.pyqtSignal(Option)
 	sectionAdded = QtCore.pyqtSignal(configobj.Section)
 	sectionRemoved = QtCore.pyqtSignal(configobj.Section)
+	snapshotPublished = QtCore.pyqtSignal(object)
 
 	def changePage(self, newItem):
 		index = self.pages[id(newItem)]
@@ -663,7 +785,9 @@ class ConfigWindow(QtGui.QMainWindow):
 
 	def updateOriginalConf(self):
 		if self.when_apply != ConfigWindow.APPLY_IMMEDIATELY: # Check what has changed
+			changed = [] # Paths of sections whose contents changed
 			def update(new, old, newly_added):
+				path = section_path(new)
 				added = [x for x in new.sections if x not in old.sections]
 				for section in added:
 					if not newly_added:
@@ -675,6 +799,9 @@ class ConfigWindow(QtGui.QMainWindow):
 					self.sectionRemoved.emit(new[section])
 					del old[section]
 
+				if added or removed:
+					changed.append(path)
+
 				for scalar in new.scalars:
 					# New section
 					if not scalar in old.scalars:
@@ -682,19 +809,23 @@ class ConfigWindow(QtGui.QMainWindow):
 							try:
 								old[scalar] = new[scalar].get()
 								self.optionChanged.emit(new[scalar])
+								changed.append(path)
 							except KeyError:
 								continue
 					else: # Old section
 						try:
 							if new[scalar].get() != old[scalar]:
 								self.optionChanged.emit(new[scalar])
+								changed.append(path)
 						except KeyError:
 							continue
 
 						if not new[scalar].isDefault():
 							old[scalar] = new[scalar].get()
-						else:
-							old.restore_default(scalar)
+						else: # Copy the default, the original may not know it if the spec was reloaded
+							old[scalar] = new[scalar].get()
+							old.defaults.append(scalar)
+							old.default_values[scalar] = new[scalar].section.default_values[scalar]
 
 				for section in [x for x in new.sections]:
 					try:
@@ -703,6 +834,7 @@ class ConfigWindow(QtGui.QMainWindow):
 						continue
 
 			update(self.options,self.original_conf,False)
+			self.publishSnapshot(changed)
 
 	def resetAll(self):
 		for page in [self.stacked.widget(i) for i in range(self.stacked.count())]:
@@ -711,11 +843,293 @@ class ConfigWindow(QtGui.QMainWindow):
 	def addPage(self, page):
 		self.pages[id(page.item)] = self.stacked.addWidget(page)
 		if self.when_apply == ConfigWindow.APPLY_IMMEDIATELY:
+			page.optionChanged.connect(lambda option: self.publishSnapshot([section_path(option.section)]))
 			page.optionChanged.connect(self.optionChanged.emit)
+		path = section_path(page.conf)
+		for option in [page.conf[x] for x in page.conf.scalars]:
+			self.index['/'.join(path + [option.name])] = option
 
 	def removePage(self, page):
 		self.pages[id(page.item)] = self.stacked.removeWidget(page)
 		del self.pages[id(page.item)]
+		prefix = '/'.join(section_path(page.conf) + [''])
+		for path in [x for x in self.index if x.startswith(prefix)]:
+			del self.index[path]
+
+	def publishSnapshot(self, paths=None):
+		"""Publish a new ConfigSnapshot of the configuration after the sections at paths have changed
+
+		Sections outside paths are shared with the previous snapshot. If paths is None everything is rebuilt.
+		Other threads can read window.snapshot at any time without locking, since published snapshots are
+		never modified and replacing the reference is atomic."""
+		if paths == None:
+			previous, dirty = None, set()
+		else:
+			previous, dirty = self.snapshot, set()
+			for path in paths:
+				for i in range(len(path)+1): # A changed section also changes all its parents
+					dirty.add(tuple(path[:i]))
+		self.snapshot = freeze_section(self.original_conf, previous, dirty, self.snapshot.version + 1)
+		self.snapshotPublished.emit(self.snapshot)
+
+	def reloadSpec(self, spec):
+		"""Switch to a changed spec, rebuilding only the options and pages which differ from the current spec
+
+		Values entered by the user are kept. Options which still have their default value get the new default."""
+		compile_spec(spec)
+		self.conf.configspec = spec
+		self.original_conf.configspec = spec
+		changed = []
+		added = []
+		self.reloadSection(self.options, spec, changed, added)
+		if self.when_apply == ConfigWindow.APPLY_IMMEDIATELY:
+			paths = [section_path(option.section) for option in changed] + [section_path(section) for section in added]
+			if paths:
+				self.publishSnapshot(paths)
+			for section in added:
+				self.sectionAdded.emit(section)
+			for option in changed:
+				self.optionChanged.emit(option)
+
+	def reloadSection(self, combined, spec, changed=None, added=None):
+		"""Update combined section and its page to match spec
+
+		Options whose value changed are appended to changed and newly created sections to added."""
+		if changed == None:
+			changed = []
+		if added == None:
+			added = []
+		config = combined.conf
+		missing = object() # Marks options without a value
+		page = self.browser.page_lookup[id(combined.tree_item)]
+		path = section_path(combined)
+		old = combined.descriptors # Parsed when the section was merged, the spec object may have been reloaded in place
+		new = spec.descriptors
+
+		combined.spec = spec
+		combined.descriptors = new
+		combined.optional = '__many__' in spec.parent and spec != spec.parent
+		combined.many = '__many__' in spec
+
+		for name in [x for x in combined.scalars if x not in new]: # Options removed from spec
+			page.removeOption(combined[name])
+			del combined[name]
+			del self.index['/'.join(path + [name])]
+
+		for name in spec.scalars: # New and changed options
+			if old.get(name) == new[name]:
+				continue
+			previous = config.get(name, missing)
+			apply_default(config, name, spec[name], self.validator)
+			fun_name, fun_args, fun_kwargs, default, comment = new[name]
+			option = Option(name, config, fun_name, fun_args, fun_kwargs, default, comment, self.type_mapping[fun_name][0], self.type_mapping[fun_name][1])
+			if name in combined:
+				page.replaceOption(combined[name], option)
+			else:
+				page.addOption(option)
+			combined[name] = option
+			self.index['/'.join(path + [name])] = option
+			if config.get(name, missing) != previous:
+				changed.append(option)
+
+		for name in list(combined.sections):
+			if name not in config.sections: # Removed by the user, kept until updateOriginalConf applies the removal
+				continue
+			elif name in spec:
+				self.reloadSection(combined[name], spec[name], changed, added)
+			elif '__many__' in spec:
+				self.reloadSection(combined[name], spec['__many__'], changed, added)
+			else: # Section removed from spec, values are kept in the configuration
+				self.browser.removePages(combined[name])
+				del combined[name]
+
+		for name in [x for x in spec.sections if x != '__many__' and x not in combined.sections]: # New sections
+			if name not in config:
+				config[name] = {}
+			apply_spec_defaults(config[name], spec[name], self.validator)
+			combined[name] = merge_spec(config[name], spec[name], self.type_mapping)
+			combined[name].name = name
+			combined[name].parent = combined
+			self.browser.addSection(combined[name])
+			added.append(combined[name])
+			changed.extend(section_options(combined[name]))
+
+	def subscribe(self, path, handler, events=('optionChanged', 'sectionAdded', 'sectionRemoved')):
+		"""Call handler for events on the option or section at path or anywhere below it
+
+		path is e.g. 'section/level2' and may contain __many__ to match any section name at that level.
+		An empty path subscribes to everything."""
+		self.subscriptions.add(split_path(path), (handler, tuple(events)))
+
+	def unsubscribe(self, path, handler, events=('optionChanged', 'sectionAdded', 'sectionRemoved')):
+		"""Remove a handler previously added with subscribe"""
+		self.subscriptions.remove(split_path(path), (handler, tuple(events)))
+
+	def notifySubscribers(self, event, path, obj):
+		"""Call the handlers subscribed to event at path or one of its prefixes"""
+		for handler, events in self.subscriptions.match(path):
+			if event in events:
+				handler(obj)
+
+	def option(self, path):
+		"""Get the Option at path, e.g. 'section/level2/enabled'"""
+		return self.index[path]
+
+	def setMany(self, values):
+		"""Set several options at once from a dict mapping paths to values
+
+		All values are checked before anything is changed, so either every value is applied or none is.
+		Widgets of the changed options are refreshed once afterwards."""
+		converted = []
+		for path, value in values.items():
+			option = self.option(path)
+			try:
+				converted.append((option, option.convert(value)))
+			except Exception as e:
+				raise ValueError('Invalid value for %s: %s'%(path, e))
+
+		changed = []
+		for option, value in converted:
+			try:
+				if option.get() == value and not option.isDefault():
+					continue
+			except KeyError: # Option has no value yet
+				pass
+			option.section[option.name] = value
+			changed.append(option)
+
+		if changed and self.when_apply == ConfigWindow.APPLY_IMMEDIATELY:
+			self.publishSnapshot([section_path(option.section) for option in changed])
+		for option in changed:
+			option.editor.refresh()
+			if self.when_apply == ConfigWindow.APPLY_IMMEDIATELY:
+				self.optionChanged.emit(option)
+		return changed
+
+class ConfigSnapshot(Mapping):
+	"""Immutable copy of a configuration section
+
+	version is the number of the snapshot in which the section last changed, so comparing it
+	with a previously seen value is enough to find out whether anything in the section changed."""
+	__slots__ = ('_values', 'version')
+
+	def __init__(self, values, version):
+		self._values = values
+		self.version = version
+
+	def __getitem__(self, key):
+		return self._values[key]
+
+	def __iter__(self):
+		return iter(self._values)
+
+	def __len__(self):
+		return len(self._values)
+
+	def __repr__(self):
+		return 'ConfigSnapshot(%s,%s)'%(self._values, self.version)
+
+def freeze_section(section, previous, dirty, version, path=()):
+	"""Create a ConfigSnapshot of section, reusing parts of previous snapshot whose path is not in dirty"""
+	if previous != None and path not in dirty:
+		return previous
+
+	values = {}
+	for name in section.scalars:
+		value = section[name]
+		if isinstance(value, list):
+			value = tuple(value)
+		values[name] = value
+	for name in section.sections:
+		old = None
+		if previous != None and isinstance(previous.get(name), ConfigSnapshot):
+			old = previous[name]
+		values[name] = freeze_section(section[name], old, dirty, version, path + (name,))
+	return ConfigSnapshot(values, version)
+
+class PathTrie(object):
+	"""Prefix tree of values stored under paths, where __many__ matches any single path component"""
+	def __init__(self):
+		self.values = []
+		self.children = {}
+
+	def add(self, path, value):
+		"""Store value under path (list of components)"""
+		node = self
+		for name in path:
+			node = node.children.setdefault(name, PathTrie())
+		node.values.append(value)
+
+	def remove(self, path, value):
+		"""Remove value stored under path"""
+		node = self
+		for name in path:
+			node = node.children[name]
+		node.values.remove(value)
+
+	def match(self, path):
+		"""Get values stored under path and all its prefixes"""
+		values = []
+		nodes = [self]
+		for name in path:
+			values.extend(x for node in nodes for x in node.values)
+			nodes = [node.children[x] for node in nodes for x in (name, '__many__') if x in node.children]
+			if not nodes:
+				return values
+		values.extend(x for node in nodes for x in node.values)
+		return values
+
+def section_options(section):
+	"""Get the Option objects of a merged section and its subsections"""
+	options = [section[x] for x in section.scalars]
+	for subsection in section.sections:
+		options.extend(section_options(section[subsection]))
+	return options
+
+def split_path(path):
+	"""Split a path like 'section/level2/enabled' into its components"""
+	return [x for x in path.split('/') if x]
+
+def section_path(section):
+	"""Get the names of section and its parents, starting from the top-level section"""
+	path = []
+	while section.name != None:
+		path.insert(0, section.name)
+		section = section.parent
+	return path
+
+def apply_default(section, name, check, validator):
+	"""Revalidate a single option of a configuration section against a new check string
+
+	Options which have no value or only a default value get the new default. Other values are kept."""
+	try:
+		section.default_values[name] = validator.get_default_value(check)
+	except (KeyError, validate.ValidateError): # No usable default
+		section.default_values.pop(name, None)
+
+	if name not in section or name in section.defaults:
+		if name in section.defaults:
+			section.defaults.remove(name)
+			dict.__delitem__(section, name)
+			section.scalars.remove(name)
+		if name in section.default_values:
+			section[name] = section.default_values[name]
+			section.defaults.append(name)
+	else:
+		try:
+			section[name] = validator.check(check, section[name])
+		except validate.ValidateError: # Keep invalid value so the user can fix it
+			pass
+
+def apply_spec_defaults(section, spec, validator):
+	"""Fill in default values for all options in spec which are missing from section"""
+	for name in spec.scalars:
+		if name not in section:
+			apply_default(section, name, spec[name], validator)
+	for name in [x for x in spec.sections if x != '__many__']:
+		if name not in section:
+			section[name] = {}
+		apply_spec_defaults(section[name], spec[name], validator)
 
 def merge_spec(config, spec, type_mapping):
 	"""Combine config and spec into one tree in the form of Option objects"""
@@ -739,27 +1153,335 @@ def merge_spec(config, spec, type_mapping):
 		combined[section].parent = combined
 
 	# Combine individual options
+	descriptors = spec_descriptors(spec)
+	combined.descriptors = descriptors # Remember what the options were built from, for reloadSpec
 	for option in spec.scalars:
-		comment = spec.inline_comments[option]
-		if comment and comment.startswith('#'):
-			comment = comment[1:].strip()
-		fun_name, fun_args, fun_kwargs, default = validate.Validator()._parse_with_caching(spec[option]) # WARNING: Uses unoffical method!
+		fun_name, fun_args, fun_kwargs, default, comment = descriptors[option]
 		combined[option] = Option(option, config, fun_name, fun_args, fun_kwargs, default, comment, type_mapping[fun_name][0], type_mapping[fun_name][1])
 
 	return combined
 
+def spec_descriptors(spec):
+	"""Get the parsed check strings of the options in a spec section
+
+	Sections compiled with compile_spec return the stored result, others are parsed again on every call."""
+	if hasattr(spec, 'descriptors'):
+		return spec.descriptors
+
+	parser = validate.Validator()
+	descriptors = {}
+	for option in spec.scalars:
+		comment = spec.inline_comments[option]
+		if comment and comment.startswith('#'):
+			comment = comment[1:].strip()
+		fun_name, fun_args, fun_kwargs, default = parser._parse_with_caching(spec[option]) # WARNING: Uses unoffical method!
+		descriptors[option] = (fun_name, fun_args, fun_kwargs, default, comment)
+	return descriptors
+
+def compile_spec(spec, recursive=True):
+	"""Parse the check strings of a spec once and store the results in spec.descriptors of each section
+
+	A compiled spec is frozen: changes made to it afterwards are not picked up by merge_spec."""
+	if hasattr(spec, 'descriptors'): # Parse again instead of returning the frozen result
+		del spec.descriptors
+	spec.descriptors = spec_descriptors(spec)
+
+	if recursive:
+		for section in spec.sections:
+			compile_spec(spec[section])
+	return spec
+
+def load_spec(specfile, cache_dir=None):
+	"""Load and compile a spec file, reusing a pickled copy from cache_dir if the file has not changed
+
+	The cache entry is keyed by the contents of the spec file and the versions of this library,
+	configobj and validate, so it is rebuilt automatically when any of them change."""
+	if cache_dir == None:
+		return compile_spec(configobj.ConfigObj(specfile, list_values=False))
+
+	with open(specfile, 'rb') as f:
+		key = hashlib.sha1(f.read())
+	key.update(('%s %s %s'%(__version__, configobj.__version__, validate.__version__)).encode('utf-8'))
+	key = key.hexdigest()
+	name = hashlib.sha1(os.path.abspath(specfile).encode('utf-8')).hexdigest()
+	path = os.path.join(cache_dir, 'spec-%s.pickle'%name)
+
+	try:
+		with open(path, 'rb') as f:
+			cached_key, spec = pickle.load(f)
+		if cached_key == key:
+			return spec
+	except Exception: # Missing or unreadable cache entry, just rebuild it
+		pass
+
+	spec = compile_spec(configobj.ConfigObj(specfile, list_values=False))
+	try:
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		tmp = '%s.%d.tmp'%(path, os.getpid())
+		with open(tmp, 'wb') as f:
+			pickle.dump((key, spec), f, pickle.HIGHEST_PROTOCOL)
+		os.rename(tmp, path)
+	except (IOError, OSError): # Caching is only an optimization
+		pass
+	return spec
+
+class _DispatchJob(QtCore.QRunnable):
+	"""Runs the handlers for one change event in a worker thread"""
+	def __init__(self, dispatcher, key, handlers, obj):
+		QtCore.QRunnable.__init__(self)
+		self.dispatcher = dispatcher
+		self.key = key
+		self.handlers = handlers
+		self.obj = obj
+
+	def run(self):
+		errors = []
+		for handler in self.handlers:
+			try:
+				handler(self.obj)
+			except Exception as e:
+				errors.append(e)
+		# Emitted from the worker thread, so delivery to the dispatcher is queued to its own thread
+		self.dispatcher._jobDone.emit(self.key, self.obj, errors)
+
+class ChangeDispatcher(QtCore.QObject):
+	"""Delivers change events of a ConfigWindow to handlers in a thread pool instead of the GUI thread.
+
+	Repeated changes to the same option (or section) while its handlers are still running are
+	coalesced, so the handlers run once more with the latest state when the current run finishes."""
+	def __init__(self, window=None, pool=None, parent=None):
+		QtCore.QObject.__init__(self, parent)
+		if pool == None:
+			pool = QtCore.QThreadPool.globalInstance()
+		self.pool = pool
+		self.handlers = {'optionChanged':[], 'sectionAdded':[], 'sectionRemoved':[]}
+		self.running = set() # Keys of events whose handlers are currently running
+		self.pending = {} # Latest object for keys that changed again while running
+		self._jobDone.connect(self._finishJob)
+		if window != None:
+			self.attach(window)
+
+	# Signals are always emitted in the thread of the dispatcher (normally the GUI thread)
+	handlerFinished = QtCore.pyqtSignal(object)
+	handlerFailed = QtCore.pyqtSignal(object, str)
+	idle = QtCore.pyqtSignal()
+	_jobDone = QtCore.pyqtSignal(object, object, object)
+
+	def attach(self, window):
+		"""Forward change signals of window and report handler errors in its status bar"""
+		window.optionChanged.connect(lambda option: self.dispatch('optionChanged', option))
+		window.sectionAdded.connect(lambda section: self.dispatch('sectionAdded', section))
+		window.sectionRemoved.connect(lambda section: self.dispatch('sectionRemoved', section))
+		self.handlerFailed.connect(lambda obj, error: window.statusBar().showMessage('Change handler failed: %s'%error))
+
+	def addHandler(self, handler, event='optionChanged'):
+		"""Register handler to be called in a worker thread when event happens"""
+		self.handlers[event].append(handler)
+
+	def removeHandler(self, handler, event='optionChanged'):
+		"""Unregister a handler previously registered with addHandler"""
+		self.handlers[event].remove(handler)
+
+	def dispatch(self, event, obj):
+		"""Schedule handlers of event for obj, coalescing with a run already in progress"""
+		if not self.handlers[event]:
+			return
+		key = (event, id(obj))
+		if key in self.running:
+			self.pending[key] = obj
+			return
+		self.running.add(key)
+		self.pool.start(_DispatchJob(self, key, list(self.handlers[event]), obj))
+
+	def isBusy(self):
+		"""Check whether any handlers are running or waiting to run"""
+		return bool(self.running)
+
+	def _finishJob(self, key, obj, errors):
+		"""Report the result of a finished job and start a coalesced follow-up if needed"""
+		self.running.discard(key)
+		for error in errors: # One report per failed handler
+			self.handlerFailed.emit(obj, str(error))
+		if not errors:
+			self.handlerFinished.emit(obj)
+
+		if key in self.pending:
+			self.dispatch(key[0], self.pending.pop(key))
+		elif not self.running:
+			self.idle.emit()
+
+class LazyConfigFile(object):
+	"""Index of the top-level sections of a large config file, which are only parsed when loaded
+
+	The file is scanned once for section headers to find where each top-level section starts and ends.
+	A section starts with the comment and blank lines just before its header, which configobj also
+	treats as belonging to the section. Note that the scan does not understand multiline values,
+	so lines inside triple-quoted values must not look like section headers."""
+	header = re.compile(br'^[ \t]*(\[+)[ \t]*(.*?)[ \t]*\]+[ \t]*(#.*)?$', re.M)
+
+	def __init__(self, filename, configspec=None, encoding='utf-8'):
+		self.filename = filename
+		self.configspec = configspec
+		self.encoding = encoding
+		self.loaded = {} # Mapping from top-level section name to its parsed and validated copy
+		self.comments = {} # Mapping from loaded top-level section name to the comments before its header
+		self.inline_comments = {} # Mapping from loaded top-level section name to the comment on its header line
+		self.scan()
+
+	def scan(self):
+		"""Map the file and find the offsets of its top-level sections"""
+		self.offsets = {} # Mapping from top-level section name to (start, end) offset in file
+		self.sections = [] # Names of top-level sections in file order
+
+		with open(self.filename, 'rb') as f:
+			if os.fstat(f.fileno()).st_size == 0:
+				self.data = b''
+			else:
+				self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		starts = []
+		limit = 0 # Comments before a header can not extend past the previous header
+		for match in self.header.finditer(self.data):
+			if len(match.group(1)) == 1: # Only top-level sections get their own region
+				name = match.group(2).decode(self.encoding).strip('"\'')
+				starts.append((name, self.comment_start(match.start(), limit)))
+			limit = self.data.find(b'\n', match.end()) + 1 or len(self.data) # Start of the line after the header
+		self.root_end = starts[0][1] if starts else len(self.data)
+		for i, (name, start) in enumerate(starts):
+			end = starts[i+1][1] if i+1 < len(starts) else len(self.data)
+			self.offsets[name] = (start, end)
+			self.sections.append(name)
+
+	def comment_start(self, pos, limit):
+		"""Find the start of the comment and blank lines directly before offset pos, but not before limit"""
+		while pos > limit:
+			line_start = self.data.rfind(b'\n', limit, pos - 1) + 1
+			if line_start == 0:
+				line_start = limit
+			line = self.data[line_start:pos].strip()
+			if line and not line.startswith(b'#'):
+				break
+			pos = line_start
+		return pos
+
+	def text(self, start, end):
+		"""Get the lines of the file between two offsets"""
+		return self.data[start:end].decode(self.encoding).splitlines()
+
+	def parse(self, lines):
+		"""Parse lines into a ConfigObj validated against the spec"""
+		conf = configobj.ConfigObj(lines, configspec=self.configspec, encoding=self.encoding)
+		if self.configspec != None:
+			conf.validate(validate.Validator(), preserve_errors=True)
+		return conf
+
+	def section(self, name):
+		"""Get the parsed copy of top-level section name, parsing it on first use"""
+		if name not in self.loaded:
+			start, end = self.offsets[name]
+			part = self.parse(self.text(start, end))
+			self.loaded[name] = part[name]
+			self.comments[name] = part.initial_comment + part.comments[name]
+			self.inline_comments[name] = part.inline_comments[name]
+		return self.loaded[name]
+
+	def load(self, names=None):
+		"""Create a ConfigObj with the top-level options and the given top-level sections (all if names is None)"""
+		if names == None:
+			names = self.sections
+		conf = self.parse(self.text(0, self.root_end))
+		conf.filename = self.filename
+		for name in [x for x in self.sections if x in conf.sections]: # Validation adds placeholders holding only defaults
+			del conf[name]
+		for name in names:
+			conf[name] = self.section(name)
+			conf.comments[name] = self.comments[name]
+			conf.inline_comments[name] = self.inline_comments[name]
+		return conf
+
+	def write(self, conf, filename=None):
+		"""Write conf back, copying the text of sections which were not loaded or not changed unmodified
+
+		Sections which were not loaded may only appear in conf as placeholders holding default values
+		(e.g. added by validating conf), otherwise ValueError is raised since their contents in the file
+		are unknown to conf."""
+		def render(part):
+			return ('\n'.join(part.write()) + '\n').encode(self.encoding)
+
+		def render_section(name):
+			part = configobj.ConfigObj()
+			part[name] = conf[name]
+			part.comments[name] = conf.comments.get(name, [])
+			part.inline_comments[name] = conf.inline_comments.get(name, '')
+			return render(part)
+
+		def changed(name, start, end):
+			try:
+				return conf[name] != self.parse(self.text(start, end))[name]
+			except KeyError: # Section was removed
+				return True
+
+		def only_defaults(section):
+			return all(x in section.defaults for x in section.scalars) and all(only_defaults(section[x]) for x in section.sections)
+
+		chunks = []
+		original = self.parse(self.text(0, self.root_end))
+		if dict((x, original[x]) for x in original.scalars) != dict((x, conf[x]) for x in conf.scalars):
+			root = configobj.ConfigObj()
+			for option in [x for x in conf.scalars if x not in conf.defaults]:
+				root[option] = conf[option]
+			root.comments.update(conf.comments)
+			root.inline_comments.update(conf.inline_comments)
+			root.initial_comment = conf.initial_comment
+			chunks.append(render(root))
+		else:
+			chunks.append(self.data[0:self.root_end])
+
+		for name in self.sections:
+			start, end = self.offsets[name]
+			if name not in self.loaded:
+				if name in conf.sections and not only_defaults(conf[name]) and changed(name, start, end):
+					raise ValueError('Section %s was changed without being loaded'%name)
+				chunks.append(self.data[start:end])
+			elif not changed(name, start, end):
+				chunks.append(self.data[start:end])
+			elif name in conf.sections:
+				chunks.append(render_section(name))
+
+		for name in [x for x in conf.sections if x not in self.offsets]: # Newly added sections
+			if only_defaults(conf[name]): # Placeholder added by validation, nothing to write
+				continue
+			if not chunks[-1].endswith(b'\n'):
+				chunks.append(b'\n')
+			chunks.append(render_section(name))
+
+		data = b''.join(chunks)
+		if filename == None:
+			filename = self.filename
+		if filename == self.filename and isinstance(self.data, mmap.mmap):
+			self.data.close() # Release the mapping before replacing the file
+			self.data = b''
+		with open(filename, 'wb') as f:
+			f.write(data)
+		if filename == self.filename: # Sections that stay loaded now match the file
+			self.scan()
+			for name in [x for x in self.loaded if x not in self.offsets]: # Removed by this write
+				del self.loaded[name], self.comments[name], self.inline_comments[name]
+
 def configure_externally(config, spec):
 	"""Launch a ConfigWindow in an external process"""
-	import pickle, subprocess, time
+	import subprocess, time
 	path = __file__
 	if path.endswith('.pyc'):
 		path = path[:-1]
+	if not hasattr(spec, 'descriptors'): # Send a parsed copy of the spec along so the child does not have to parse it again
+		spec = compile_spec(copy.deepcopy(spec))
 	proc = subprocess.Popen([path], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
 	newconf = pickle.loads(proc.communicate(pickle.dumps((config, spec)))[0])
 	newconf.write(sys.stdout)
 
 if __name__ == '__main__':
-	import pickle
 	conf, spec = pickle.loads(sys.stdin.read())
 	app = QtGui.QApplication(sys.argv)
 	wnd = ConfigWindow(conf, spec)
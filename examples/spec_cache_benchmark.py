@@ -0,0 +1,53 @@
+from __future__ import print_function
+
+import os
+import time
+import shutil
+import tempfile
+
+import sip
+sip.setapi('QString', 1)
+
+import configobj
+import configobj_gui
+import validate
+
+def write_spec(path, sections=200, options=50):
+	"""Generate a large spec file"""
+	with open(path, 'w') as f:
+		for i in range(sections):
+			f.write('[section%d]\n'%i)
+			for j in range(options):
+				f.write("option%d = integer(default=%d, min=0, max=1000) # Option %d\n"%(j, j, j))
+				f.write("choice%d = option('a', 'b', 'c', default='b') # Choice %d\n"%(j, j))
+
+def startup(specfile, cache_dir):
+	"""Time what happens before a ConfigWindow can paint: loading the spec and merging it with a config"""
+	start = time.time()
+	spec = configobj_gui.load_spec(specfile, cache_dir)
+	config = configobj.ConfigObj(configspec=spec)
+	config.validate(validate.Validator())
+	configobj_gui.merge_spec(config, spec, configobj_gui.ConfigWindow.type_mapping)
+	return time.time() - start
+
+def main():
+	tmpdir = tempfile.mkdtemp()
+	try:
+		specfile = os.path.join(tmpdir, 'spec.txt')
+		cache_dir = os.path.join(tmpdir, 'cache')
+		write_spec(specfile)
+
+		uncached = min(startup(specfile, None) for i in range(3))
+		cold = []
+		for i in range(3):
+			shutil.rmtree(cache_dir, ignore_errors=True)
+			cold.append(startup(specfile, cache_dir))
+		warm = min(startup(specfile, cache_dir) for i in range(3))
+
+		print('No cache:   %.3f s'%uncached)
+		print('Cold cache: %.3f s'%min(cold))
+		print('Warm cache: %.3f s'%warm)
+	finally:
+		shutil.rmtree(tmpdir)
+
+main()